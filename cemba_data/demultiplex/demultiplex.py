@@ -3,9 +3,11 @@ Demultiplex pipeline
 """
 
 import logging
+import os
 import pathlib
 import re
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 
@@ -21,6 +23,12 @@ log.addHandler(logging.NullHandler())
 
 PACKAGE_DIR = pathlib.Path(cemba_data.__path__[0])
 
+CUTADAPT_ADAPTER_PATTERN = re.compile(
+    r"Sequence: .+; Type: .+; Length: \d+; Trimmed: \d+ times")
+# demultiplexed lane FASTQ name: {uid}-{lane}-{index_name}-{read_type}.fq.gz
+LANE_FASTQ_PATTERN = re.compile(
+    r'^(?P<uid>.+)-(?P<lane>[^-]+)-(?P<index>[^-]+)-(?P<read>R[12])\.fq\.gz$')
+
 
 def _demultiplex(fastq_pattern, output_dir, barcode_version, cpu):
     """
@@ -60,42 +68,55 @@ def _demultiplex(fastq_pattern, output_dir, barcode_version, cpu):
         # the resulting demultiplexed dir will have all the 384 cells.
         # I added a patch in the end to split them into multiplex groups that each sub-dir only contain 64 cells.
 
+    # determine index file path, for V2 each multiplex group has its own index file
+    if barcode_version == 'V1':
+        random_index_fasta_path = str(PACKAGE_DIR / 'files/random_index_v1.fa')
+    elif barcode_version == 'V2':
+        v2_fasta_paths = {
+            path.stem.split('_')[-1]: str(path)
+            for path in (PACKAGE_DIR / 'files/random_index_v2').glob(
+                'random_index_v2.multiplex_group_*.fa')
+        }
+    elif barcode_version == 'V2-single':
+        random_index_fasta_path = str(PACKAGE_DIR /
+                                      'files/random_index_v2/random_index_v2.fa')
+    else:
+        raise ValueError(f'Got unknown barcode version {barcode_version}.')
+
     # prepare UID sub dir
     snakefile_list = []
     total_stats_list = []
     rule_count = 0
+
+    # create the lanes and raw directory for each uid in one pass
+    uid_dirs = {output_dir / uid / sub_dir
+                for uid in fastq_df['uid'].unique()
+                for sub_dir in ('lanes', 'raw')}
+    for uid_dir in sorted(uid_dirs):
+        uid_dir.mkdir(parents=True, exist_ok=True)
+
     for uid, uid_df in fastq_df.groupby('uid'):
-        # determine index file path
-        if barcode_version == 'V1':
-            random_index_fasta_path = str(PACKAGE_DIR /
-                                          'files/random_index_v1.fa')
-        elif barcode_version == 'V2':
+        if barcode_version == 'V2':
             multiplex_group = uid.split('-')[-2]
-            random_index_fasta_path = str(
-                PACKAGE_DIR / 'files/random_index_v2/'
-                              f'random_index_v2.multiplex_group_{multiplex_group}.fa')
-        elif barcode_version == 'V2-single':
-            random_index_fasta_path = str(PACKAGE_DIR /
-                                          'files/random_index_v2/'
-                                          f'random_index_v2.fa')
-        else:
-            raise ValueError(f'Got unknown barcode version {barcode_version}.')
-
-        # create a directory for each uid, within this UID, do multiplex and lane merge
+            try:
+                random_index_fasta_path = v2_fasta_paths[multiplex_group]
+            except KeyError:
+                raise ValueError(f'Got unknown multiplex group {multiplex_group} in uid {uid}.')
+
+        # within each uid dir, do multiplex and lane merge
         uid_output_dir = output_dir / uid
-        uid_output_dir.mkdir(exist_ok=True)
         lane_files_dir = uid_output_dir / 'lanes'
-        lane_files_dir.mkdir(exist_ok=True)
 
         # standardize input fastq name for easier parsing
         raw_dir = uid_output_dir / 'raw'
-        raw_dir.mkdir(exist_ok=True)
-        for _, row in uid_df.iterrows():
-            uid, read_type, lane, old_path = row[[
-                'uid', 'read_type', 'lane', 'fastq_path'
-            ]]
+        fastq_records = uid_df[['uid', 'read_type', 'lane', 'fastq_path'
+                                ]].itertuples(index=False, name=None)
+        for uid, read_type, lane, old_path in fastq_records:
             new_path = raw_dir / f'{uid}+{lane}+{read_type}.fq.gz'
-            subprocess.run(['ln', '-s', old_path, new_path], check=True)
+            try:
+                os.symlink(os.fspath(old_path), os.fspath(new_path))
+            except FileExistsError:
+                pass
         lanes = list(uid_df['lane'].unique())
         name_str = '{{name}}'
 
@@ -105,27 +126,27 @@ def _demultiplex(fastq_pattern, output_dir, barcode_version, cpu):
             for lane in lanes
         ]
         total_stats_list += stats_out_list
-        rules = ""
-        for lane in lanes:
-            snake_file_template = f"""
+        # one rule per uid, lanes are expanded as jobs through the {lane} wildcard
+        rules = f"""
 rule demultiplex_{rule_count}:
     input:
-        r1_in = f'{raw_dir}/{uid}+{lane}+R1.fq.gz',
-        r2_in = f'{raw_dir}/{uid}+{lane}+R2.fq.gz'
+        r1_in = '{raw_dir}/{uid}+{{lane}}+R1.fq.gz',
+        r2_in = '{raw_dir}/{uid}+{{lane}}+R2.fq.gz'
     params:
         # Note that you have to use a function to deactivate automatic wildcard expansion 
         # in params strings, e.g., `lambda wildcards: ...`.
         # here the r1/2_out have to have the name_str
-        r1_out = lambda wildcards: f'{lane_files_dir}/{uid}-{lane}-{name_str}-R1.fq.gz',
-        r2_out = lambda wildcards: f'{lane_files_dir}/{uid}-{lane}-{name_str}-R2.fq.gz'
+        r1_out = lambda wildcards: f'{lane_files_dir}/{uid}-{{wildcards.lane}}-{name_str}-R1.fq.gz',
+        r2_out = lambda wildcards: f'{lane_files_dir}/{uid}-{{wildcards.lane}}-{name_str}-R2.fq.gz'
     output:
-        stats_out = '{lane_files_dir}/{uid}-{lane}.demultiplex.stats.txt'
+        stats_out = '{lane_files_dir}/{uid}-{{lane}}.demultiplex.stats.txt'
+    wildcard_constraints:
+        lane = '[^/+-]+'
     shell:
         "cutadapt -Z -e 0.01 --no-indels -g file:{random_index_fasta_path} "
         "-o {{params.r1_out}} -p {{params.r2_out}} {{input.r1_in}} {{input.r2_in}} > {{output.stats_out}}"
     """
-            rule_count += 1
-            rules += snake_file_template
+        rule_count += 1
 
         snake_file_path = lane_files_dir / 'Snakefile'
         with open(snake_file_path, 'w') as f:
@@ -136,11 +157,8 @@ rule demultiplex_{rule_count}:
     final_rules = ''
     for path in snakefile_list:
         final_rules += f'include: "{path}"\n'
-    # final rules
-    final_rules += f"""
-rule final:
-    input: {total_stats_list}
-"""
+    # final rules, one input path per line
+    final_rules += _make_final_rule(total_stats_list)
     final_snake_path = output_dir / 'Snakefile_demultiplex'
     with open(final_snake_path, 'w') as f:
         f.write(final_rules)
@@ -150,6 +168,22 @@ rule final:
     return barcode_version
 
 
+def _make_final_rule(input_paths):
+    """Make the final rule of a Snakefile with one input path per line"""
+    inputs_block = ',\n        '.join(f'"{path}"' for path in input_paths)
+    return f"""
+rule final:
+    input:
+        {inputs_block}
+"""
+
+
+def _scan_files(dir_path, suffix):
+    """List the DirEntry of files directly under dir_path whose name ends with suffix"""
+    with os.scandir(dir_path) as entries:
+        return [entry for entry in entries if entry.name.endswith(suffix)]
+
+
 def _merge_lane(output_dir, cpu):
     output_dir = pathlib.Path(output_dir).absolute()
     fastq_df = pd.read_csv(output_dir / 'stats' / 'fastq_dataframe.csv')
@@ -165,14 +199,16 @@ def _merge_lane(output_dir, cpu):
 
         # prepare demultiplex results cell_fastq_df
         records = []
-        for path in lanes_dir.glob('*fq.gz'):
-            *uid, lane, index_name, read_type = path.name[:-6].split('-')
-            uid = '-'.join(uid)
+        for entry in _scan_files(lanes_dir, 'fq.gz'):
+            m = LANE_FASTQ_PATTERN.match(entry.name)
+            if m is None:
+                continue
+            uid, lane, index_name, read_type = m.group('uid', 'lane', 'index', 'read')
             cell_id = f'{uid}-{index_name}'
-            records.append([cell_id, lane, read_type, str(path)])
+            records.append([cell_id, lane, read_type, entry.path])
         cell_fastq_df = pd.DataFrame(
             records,
-            columns=['cell_id', 'index_name', 'read_type', 'fastq_path'])
+            columns=['cell_id', 'lane', 'read_type', 'fastq_path'])
 
         # prepare snakefile for each cell_id * read_type
         rules = ''
@@ -183,6 +219,12 @@ def _merge_lane(output_dir, cpu):
             input_paths = sorted(sub_df['fastq_path'].tolist())
             output_path = fastq_dir / f'{cell_id}-{read_type}.fq.gz'
 
+            if len(input_paths) == 1:
+                # single lane, the demultiplexed file is already the cell FASTQ
+                merge_cmd = 'mv {input} {output}'
+            else:
+                # concatenated gzip members are still a valid gzip file, no need to recompress
+                merge_cmd = 'cat {input} > {output} && rm -f {input}'
             snake_file_template = f"""
 rule merge_{rule_uid}:
     input: 
@@ -190,7 +232,7 @@ rule merge_{rule_uid}:
     output: 
         "{output_path}"
     shell:
-        "gzip -cd {{input}} | gzip -5 > {{output}} && rm -f {{input}}"
+        "{merge_cmd}"
 
 """
             rule_uid += 1
@@ -207,11 +249,8 @@ rule merge_{rule_uid}:
     final_rules = ''
     for path in snakefile_list:
         final_rules += f'include: "{path}"\n'
-    # final rules
-    final_rules += f"""
-rule final:
-    input: {total_output_list}
-"""
+    # final rules, one input path per line
+    final_rules += _make_final_rule(total_output_list)
     final_snake_path = output_dir / 'Snakefile_merge_lane'
     with open(final_snake_path, 'w') as f:
         f.write(final_rules)
@@ -241,32 +280,23 @@ def _read_cutadapt_result(stat_path):
     Parser of cutadapt output
     """
     with open(stat_path) as f:
-        p = re.compile(
-            r"Sequence: .+; Type: .+; Length: \d+; Trimmed: \d+ times")
-        series = []
+        rows = []
         total_pairs = -1
         for line in f:
             if line.startswith('Total read pairs processed'):
-                total_pairs = line.split(' ')[-1]
-                total_pairs = int(''.join(re.compile(r'\d').findall(total_pairs)))
+                total_pairs = int(line.rsplit(' ', 1)[-1].replace(',', '').strip())
 
-            m = p.search(line)
+            m = CUTADAPT_ADAPTER_PATTERN.search(line)
             if m is not None:
-                result_dict = {}
-                for i in m.group().split('; '):
-                    k, v = i.split(': ')
-                    result_dict[k] = v
-                result_series = pd.Series(result_dict)
-                series.append(result_series)
-        total_df = pd.DataFrame(series)
-        total_df['Trimmed'] = total_df['Trimmed'].apply(
-            lambda c: c.split(' ')[0]).astype(int)
-        total_df['TotalPair'] = total_pairs
-        total_df['Ratio'] = total_df['Trimmed'] / total_pairs
+                rows.append(dict(i.split(': ', 1) for i in m.group().split('; ')))
+    total_df = pd.DataFrame(rows, columns=['Sequence', 'Type', 'Length', 'Trimmed'])
+    total_df['Trimmed'] = total_df['Trimmed'].str.split(' ', n=1).str[0].astype('int64')
+    total_df['TotalPair'] = total_pairs
+    total_df['Ratio'] = total_df['Trimmed'] / total_pairs
     return total_df
 
 
-def _summarize_demultiplex(output_dir, barcode_version):
+def _summarize_demultiplex(output_dir, barcode_version, cpu=1):
     output_dir = pathlib.Path(output_dir).absolute()
     output_path = output_dir / 'stats' / 'demultiplex.stats.csv'
     barcode_version = barcode_version.upper()
@@ -290,10 +320,16 @@ def _summarize_demultiplex(output_dir, barcode_version):
     # read the demultiplex stats, its per lane, so need to sum up lane together of each uid and index name
     # but R1 R2 is demultiplexed together, so this table don't separate R1 R2
     stat_list = []
-    stat_path_list = list(output_dir.glob('*/lanes/*demultiplex.stats.txt'))
-    for path in stat_path_list:
-        single_df = _read_cutadapt_result(path)
-        *uid, suffix = path.name.split('-')
+    stat_path_list = []
+    with os.scandir(output_dir) as uid_entries:
+        for uid_entry in uid_entries:
+            lanes_dir = os.path.join(uid_entry.path, 'lanes')
+            if uid_entry.is_dir() and os.path.isdir(lanes_dir):
+                stat_path_list += [entry.path for entry in _scan_files(lanes_dir, 'demultiplex.stats.txt')]
+    with ProcessPoolExecutor(cpu) as exe:
+        single_df_list = list(exe.map(_read_cutadapt_result, stat_path_list, chunksize=16))
+    for path, single_df in zip(stat_path_list, single_df_list):
+        *uid, suffix = os.path.basename(path).split('-')
         lane = suffix.split('.')[0]
         uid = '-'.join(uid)
         single_df['uid'] = uid
@@ -301,22 +337,30 @@ def _summarize_demultiplex(output_dir, barcode_version):
         single_df['index_name'] = single_df['Sequence'].map(index_name_dict)
         assert single_df['index_name'].isna().sum() == 0
         stat_list.append(single_df)
-    total_demultiplex_stats = pd.concat(stat_list)
+    total_demultiplex_stats = pd.concat(stat_list, ignore_index=True)
 
     # calculate cell level table
     total_demultiplex_stats['cell_id'] = total_demultiplex_stats[
                                              'uid'] + '-' + total_demultiplex_stats['index_name']
-
-    cell_table = total_demultiplex_stats.groupby('cell_id').agg({
-        'Trimmed':
-            'sum',
-        'TotalPair':
-            'sum',
-        'index_name':
-            lambda i: i.unique()[0],
-        'uid':
-            lambda i: i.unique()[0]
+    # the string columns only have a few hundred distinct values, store them as categories
+    total_demultiplex_stats = total_demultiplex_stats.astype({
+        'Sequence': 'category',
+        'Type': 'category',
+        'Length': 'int32',
+        'uid': 'category',
+        'lane': 'category',
+        'index_name': 'category',
+        'cell_id': 'category',
+        'Trimmed': 'int64',
+        'TotalPair': 'int64'
     })
+
+    # index_name and uid are constant within each cell_id, so take them from the first row
+    cell_sums = total_demultiplex_stats.groupby(
+        'cell_id', sort=False, observed=True)[['Trimmed', 'TotalPair']].sum()
+    cell_meta = total_demultiplex_stats.drop_duplicates('cell_id').set_index(
+        'cell_id')[['index_name', 'uid']]
+    cell_table = cell_sums.join(cell_meta).sort_index()
     cell_table.rename(columns={
         'Trimmed': 'CellInputReadPairs',
         'TotalPair': 'MultiplexedTotalReadPairs',
@@ -457,7 +501,8 @@ def demultiplex_pipeline(fastq_pattern, output_dir, config_path, cpu, aligner):
                                        cpu=demultiplex_cpu)
     _merge_lane(output_dir=output_dir, cpu=merge_cpu)
     _summarize_demultiplex(output_dir=output_dir,
-                           barcode_version=barcode_version)
+                           barcode_version=barcode_version,
+                           cpu=demultiplex_cpu)
     _final_cleaning(output_dir=output_dir)
     if demultiplex_version == 'V2-single':
         print('Reformat directories to separate multiplex groups')
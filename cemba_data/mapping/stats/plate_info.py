@@ -1,52 +1,61 @@
+import numpy as np
 import pandas as pd
 
+# V1 random index to (col, row) offset inside each 96-well position on the 384 plate
+AD_INDEX_384_DICT = {
+    'AD001': (0, 0),
+    'AD002': (0, 1),
+    'AD004': (1, 0),
+    'AD006': (1, 1),
+    'AD007': (0, 0),
+    'AD008': (0, 1),
+    'AD010': (1, 0),
+    'AD012': (1, 1)
+}
 
-def _parse_cell_id_v1(cell_id):
-    plate1, plate2, pcr_index, random_index = cell_id.split('-')
-    if random_index.upper() in {'AD001', 'AD002', 'AD004', 'AD006'}:
-        plate = plate1
-    else:
-        plate = plate2
+
+def _split_cell_ids(cell_ids, columns):
+    parts = pd.Series(cell_ids, dtype=str).str.split('-', expand=True)
+    if parts.shape[1] != len(columns):
+        raise ValueError(f'Cell id do not have {len(columns)} fields separated by "-".')
+    parts.columns = columns
+    return parts
+
+
+def _parse_cell_id_v1(cell_ids):
+    parts = _split_cell_ids(cell_ids, ['Plate1', 'Plate2', 'PCRIndex', 'RandomIndex'])
+    random_index = parts['RandomIndex']
+    plate = np.where(random_index.str.upper().isin({'AD001', 'AD002', 'AD004', 'AD006'}),
+                     parts['Plate1'], parts['Plate2'])
     # 96 pos
-    col96 = int(pcr_index[1:]) - 1
-    row96 = ord(pcr_index[0]) - 65  # convert A-H to 0-8
+    col96 = parts['PCRIndex'].str[1:].astype(int) - 1
+    row96 = parts['PCRIndex'].str[0].map(ord) - 65  # convert A-H to 0-8
     # 384 pos
-    ad_index_384_dict = {
-        'AD001': (0, 0),
-        'AD002': (0, 1),
-        'AD004': (1, 0),
-        'AD006': (1, 1),
-        'AD007': (0, 0),
-        'AD008': (0, 1),
-        'AD010': (1, 0),
-        'AD012': (1, 1)
-    }
-    col384 = 2 * col96 + ad_index_384_dict[random_index][0]
-    row384 = 2 * row96 + ad_index_384_dict[random_index][1]
-    record = pd.Series({
+    col_offset = random_index.map({k: v[0] for k, v in AD_INDEX_384_DICT.items()})
+    row_offset = random_index.map({k: v[1] for k, v in AD_INDEX_384_DICT.items()})
+    records = pd.DataFrame({
         'Plate': plate,
-        'PCRIndex': pcr_index,
+        'PCRIndex': parts['PCRIndex'],
         'RandomIndex': random_index,
-        'Col384': col384,
-        'Row384': row384
+        'Col384': 2 * col96 + col_offset.astype(int),
+        'Row384': 2 * row96 + row_offset.astype(int)
     })
-    return record
+    return records
 
 
-def _parse_cell_id_v2(cell_id):
-    plate, multiplex_group, pcr_index, random_index = cell_id.split('-')
-    # 384 pos
-    col384 = int(random_index[1:]) - 1
-    row384 = ord(random_index[0]) - 65  # convert A-P to 0-23
-    record = pd.Series({
-        'Plate': plate,
-        'PCRIndex': pcr_index,
-        'MultiplexGroup': multiplex_group,
+def _parse_cell_id_v2(cell_ids):
+    parts = _split_cell_ids(cell_ids, ['Plate', 'MultiplexGroup', 'PCRIndex', 'RandomIndex'])
+    random_index = parts['RandomIndex']
+    records = pd.DataFrame({
+        'Plate': parts['Plate'],
+        'PCRIndex': parts['PCRIndex'],
+        'MultiplexGroup': parts['MultiplexGroup'],
         'RandomIndex': random_index,
-        'Col384': col384,
-        'Row384': row384
+        # 384 pos
+        'Col384': random_index.str[1:].astype(int) - 1,
+        'Row384': random_index.str[0].map(ord) - 65  # convert A-P to 0-23
     })
-    return record
+    return records
 
 
 def get_plate_info(cell_ids, barcode_version):
@@ -55,8 +64,8 @@ def get_plate_info(cell_ids, barcode_version):
     else:
         func = _parse_cell_id_v2
     try:
-        plate_info = pd.DataFrame([func(cell_id) for cell_id in cell_ids],
-                                  index=cell_ids)
+        plate_info = func(cell_ids)
+        plate_info.index = cell_ids
     except Exception:
         print('Errors occur during parsing the plate info, this happens '
               'when the input FASTQ file name is not generated by yap. '